@@ -15,14 +15,39 @@ weewx configuration file:
 [Engine]
     [[Services]]
         process_services = ..., user.cwxn.CumulusWXNow
+
+When rain totals are not in the packet, they are calculated from the archive.
+To make those queries cheaper, the service creates an index cwxn_dt_rain on
+(dateTime, rain) in the wx_binding archive table.  The index uses some disk
+space and adds a little work to each archive insert.  It is not removed when
+the extension is uninstalled; to remove it from a sqlite database:
+
+    sqlite3 /path/to/weewx.sdb "DROP INDEX cwxn_dt_rain"
+
+Each update is written to a temporary file (filename plus .tmp) that is then
+renamed over the output file, so readers never see a partial file.  This means
+weewx must be able to create files in the directory that contains the output
+file; write permission on the file alone is not enough.  Since the file is
+replaced on every update, it gets the owner and umask of the weewx process,
+and if the output path is a symlink, the link is replaced by a regular file.
 """
 
 # FIXME: when value is None, we insert a 0.  but is there something in the
 #        aprs spec that is more appropriate?
 
+import os
+import threading
 import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import weedb
 import weewx
+import weewx.manager
+import weewx.units
 import weewx.wxformulas
 import weeutil.weeutil
 import weeutil.Sun
@@ -67,18 +92,32 @@ except ImportError:
     def log_traceback_error(prefix=''):
         log_traceback(prefix=prefix, loglevel=syslog.LOG_ERR)
 
-VERSION = "0.5"
+VERSION = "0.6"
 
 if weewx.__version__ < "3":
     raise weewx.UnsupportedFeature("WeeWX 3 is required, found %s" %
                                    weewx.__version__)
 
+# fields in the order they appear in wxnow.txt.  each is a tuple of
+# (observation, format, metric, unit group, target units, scale).  fields
+# without a metric are written as they are found in the packet.
+FIELDS = [
+    ('windDir', '%03d', None, None, None, 1),
+    ('windSpeed', '/%03d', 'windSpeed', 'group_speed', 'mile_per_hour', 1),
+    ('windGust', 'g%03d', 'windGust', 'group_speed', 'mile_per_hour', 1),
+    ('outTemp', 't%03d', 'outTemp', 'group_temperature', 'degree_F', 1),
+    ('hourRain', 'r%03d', 'rain', 'group_rain', 'inch', 100),
+    ('rain24', 'p%03d', 'rain', 'group_rain', 'inch', 100),
+    ('dayRain', 'P%03d', 'rain', 'group_rain', 'inch', 100),
+    ('outHumidity', 'h%03d', None, None, None, 1),
+    ('barometer', 'b%05d', 'pressure', 'group_pressure', 'mbar', 10),
+]
 
-def convert(v, metric, group, from_unit_system, to_units):
-    ut = weewx.units.getStandardUnitType(from_unit_system, metric)
-    vt = (v, ut[0], group)
-    v = weewx.units.convert(vt, to_units)[0]
-    return v
+# rain totals, in the order they are returned by calcRain
+RAIN_FIELDS = ('hourRain', 'rain24', 'dayRain')
+
+# timestamp line followed by the observations line
+TEMPLATE = "%s\n" + ''.join([f[1] for f in FIELDS]) + "\n"
 
 
 def nullproof(key, data):
@@ -87,34 +126,19 @@ def nullproof(key, data):
     return 0
 
 
-def calcRainHour(dbm, ts):
-    sts = ts - 3600
-    val = dbm.getSql("SELECT SUM(rain) FROM %s "
-                     "WHERE dateTime>? AND dateTime<=?" % dbm.table_name,
-                     (sts, ts))
-    if val is None:
-        return None
-    return val[0]
-
-
-def calcRain24(dbm, ts):
-    sts = ts - 86400
-    val = dbm.getSql("SELECT SUM(rain) FROM %s "
+def calcRain(dbm, ts):
+    # rain in the past hour, past 24 hours, and since midnight, in one query
+    sod = weeutil.weeutil.startOfDay(ts)
+    val = dbm.getSql("SELECT "
+                     "SUM(CASE WHEN dateTime>? THEN rain END), "
+                     "SUM(CASE WHEN dateTime>? THEN rain END), "
+                     "SUM(CASE WHEN dateTime>? THEN rain END) "
+                     "FROM %s "
                      "WHERE dateTime>? AND dateTime<=?" % dbm.table_name,
-                     (sts, ts))
+                     (ts - 3600, ts - 86400, sod, min(ts - 86400, sod), ts))
     if val is None:
-        return None
-    return val[0]
-
-
-def calcDayRain(dbm, ts):
-    sts = weeutil.weeutil.startOfDay(ts)
-    val = dbm.getSql("SELECT SUM(rain) FROM %s "
-                     "WHERE dateTime>? AND dateTime<=?" % dbm.table_name,
-                     (sts, ts))
-    if val is None:
-        return None
-    return val[0]
+        return None, None, None
+    return val[0], val[1], val[2]
 
 
 class CumulusWXNow(StdService):
@@ -122,8 +146,25 @@ class CumulusWXNow(StdService):
     def __init__(self, engine, config_dict):
         super(CumulusWXNow, self).__init__(engine, config_dict)
         loginf("service version is %s" % VERSION)
+        self.config_dict = config_dict
         d = config_dict.get('CumulusWXNow', {})
         self.filename = d.get('filename', '/var/tmp/wxnow.txt')
+        self.tmpname = self.filename + '.tmp'
+        self._last_min = -1
+        self._last_hdr = ''
+        self._last_payload = None
+        # the file is written by a separate thread so that a slow disk never
+        # holds up the engine.  only the newest pending payload is kept.
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+        self._dbm = None
+        self._rain_cache = dict()
+        self._conv_cache = dict()
+        # the archive only changes when a new record arrives, so that is when
+        # any cached rain totals become invalid
+        self.bind(weewx.NEW_ARCHIVE_RECORD, self.clear_rain_cache)
         binding = d.get('binding', 'loop').lower()
         if binding == 'loop':
             self.bind(weewx.NEW_LOOP_PACKET, self.handle_new_loop)
@@ -133,67 +174,159 @@ class CumulusWXNow(StdService):
         loginf("binding is %s" % binding)
         loginf("output goes to %s" % self.filename)
 
+    def open_manager(self):
+        # use our own manager rather than the one cached by the engine's
+        # binder, so that it can be closed and reopened after an error.
+        if self._dbm is None:
+            self._dbm = weewx.manager.open_manager_with_config(
+                self.config_dict, 'wx_binding')
+            self.create_rain_index(self._dbm)
+        return self._dbm
+
+    def close_manager(self):
+        if self._dbm is not None:
+            try:
+                self._dbm.close()
+            except weedb.DatabaseError:
+                pass
+            self._dbm = None
+
+    def create_rain_index(self, dbm):
+        # a covering index lets the rain sums be answered from the index
+        # alone, without visiting each archive row.
+        try:
+            dbm.connection.execute("CREATE INDEX IF NOT EXISTS cwxn_dt_rain "
+                                   "ON %s (dateTime, rain)" % dbm.table_name)
+        except weedb.DatabaseError as e:
+            loginf("cannot create rain index: %s" % e)
+
+    def shutDown(self):
+        self.close_manager()
+        # queue the sentinel behind any pending payload so that the last
+        # update still gets written
+        try:
+            self._queue.put(None, timeout=10.0)
+        except queue.Full:
+            logerr("writer thread is not responding")
+            return
+        self._thread.join(10.0)
+
+    def _post(self, payload):
+        # replace anything still waiting, since it is out of date anyway
+        while True:
+            try:
+                self._queue.put_nowait(payload)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _writer(self):
+        while True:
+            payload = self._queue.get()
+            if payload is None:
+                break
+            try:
+                self._write_payload(payload)
+            except (IOError, OSError) as e:
+                logerr("write to %s failed: %s" % (self.filename, e))
+                # make sure the next payload is written even if it matches
+                self._last_payload = None
+            except Exception:
+                log_traceback_error('cwxn: **** ')
+                self._last_payload = None
+
+    def _convert(self, v, metric, group, from_unit_system, to_units):
+        # the conversion depends only on the unit system of the packet, so
+        # look up the conversion function once and reuse it.
+        key = (from_unit_system, metric, to_units)
+        if key not in self._conv_cache:
+            ut = weewx.units.getStandardUnitType(from_unit_system, metric)
+            if ut[0] == to_units:
+                func = None
+            else:
+                func = weewx.units.conversionDict[ut[0]][to_units]
+            self._conv_cache[key] = func
+        func = self._conv_cache[key]
+        return v if func is None else func(v)
+
     def handle_new_loop(self, event):
         self.handle_data(event.packet)
 
     def handle_new_archive(self, event):
         self.handle_data(event.record)
 
+    def clear_rain_cache(self, _event=None):
+        self._rain_cache = dict()
+
+    def _cached(self, fn, dbm, ts, ttl=60):
+        # reuse a query result for every packet within the same ttl bucket
+        bucket = ts // ttl
+        entry = self._rain_cache.get(fn.__name__)
+        if entry is not None and entry[0] == bucket:
+            return entry[1]
+        v = fn(dbm, ts)
+        self._rain_cache[fn.__name__] = (bucket, v)
+        return v
+
     def handle_data(self, event_data):
         try:
-            dbm = self.engine.db_binder.get_manager('wx_binding')
-            data = self.calculate(event_data, dbm)
-            self.write_data(data)
-        except Exception as e:
+            self._emit(event_data, self.open_manager())
+        except weedb.DatabaseError as e:
+            # the connection might have gone stale, so reopen it next time
+            logerr("database query failed: %s" % e)
+            self.close_manager()
+        except Exception:
             log_traceback_error('cwxn: **** ')
 
-    def calculate(self, packet, archive):
+    def _emit(self, packet, archive):
         pu = packet.get('usUnits')
-        data = dict()
-        data['dateTime'] = packet['dateTime']
-        data['windDir'] = nullproof('windDir', packet)
-        v = nullproof('windSpeed', packet)
-        data['windSpeed'] = convert(v, 'windSpeed', 'group_speed', pu, 'mile_per_hour')
-        v = nullproof('windGust', packet)
-        data['windGust'] = convert(v, 'windGust', 'group_speed', pu, 'mile_per_hour')
-        v = nullproof('outTemp', packet)
-        data['outTemp'] = convert(v, 'outTemp', 'group_temperature', pu, 'degree_F')
-        v = calcRainHour(archive, data['dateTime'])
-        if v is None:
-            v = 0
-        data['hourRain'] = convert(v, 'rain', 'group_rain', pu, 'inch')
-        if 'rain24' in packet:
-            v = nullproof('rain24', packet)
-        else:
-            v = calcRain24(archive, data['dateTime'])
-            v = 0 if v is None else v
-        data['rain24'] = convert(v, 'rain', 'group_rain', pu, 'inch')
-        if 'dayRain' in packet:
-            v = nullproof('dayRain', packet)
-        else:
-            v = calcDayRain(archive, data['dateTime'])
-            v = 0 if v is None else v
-        data['dayRain'] = convert(v, 'rain', 'group_rain', pu, 'inch')
-        data['outHumidity'] = nullproof('outHumidity', packet)
-        v = nullproof('barometer', packet)
-        data['barometer'] = convert(v, 'pressure', 'group_pressure', pu, 'mbar')
-        return data
-
-    def write_data(self, data):
-        fields = []
-        fields.append("%03d" % int(data['windDir']))
-        fields.append("/%03d" % int(data['windSpeed']))
-        fields.append("g%03d" % int(data['windGust']))
-        fields.append("t%03d" % int(data['outTemp']))
-        fields.append("r%03d" % int(data['hourRain'] * 100))
-        fields.append("p%03d" % int(data['rain24'] * 100))
-        fields.append("P%03d" % int(data['dayRain'] * 100))
-        if data['outHumidity'] < 0 or 100 <= data['outHumidity']:
-            data['outHumidity'] = 0
-        fields.append("h%03d" % int(data['outHumidity']))
-        fields.append("b%05d" % int(data['barometer'] * 10))
-        with open(self.filename, 'w') as f:
-            f.write(time.strftime("%b %d %Y %H:%M\n",
-                                  time.localtime(data['dateTime'])))
-            f.write(''.join(fields))
-            f.write("\n")
+        ts = packet['dateTime']
+        # the timestamp only has minute resolution
+        minute = ts // 60
+        if minute != self._last_min:
+            self._last_hdr = time.strftime("%b %d %Y %H:%M",
+                                           time.localtime(ts))
+            self._last_min = minute
+        values = [self._last_hdr]
+        totals = None
+        for name, _, metric, group, units, scale in FIELDS:
+            if name in RAIN_FIELDS and packet.get(name) is None:
+                # the station does not provide this total, so get it from
+                # the database.  one query covers all of the rain totals.
+                if totals is None:
+                    totals = self._cached(calcRain, archive, ts)
+                v = totals[RAIN_FIELDS.index(name)]
+                v = 0 if v is None else v
+            else:
+                v = nullproof(name, packet)
+            if metric is not None:
+                v = self._convert(v, metric, group, pu, units)
+            elif name == 'outHumidity' and (v < 0 or 100 <= v):
+                v = 0
+            # %d truncates floats the same way int() does
+            values.append(v * scale)
+        payload = TEMPLATE % tuple(values)
+        # nothing to do if these contents were already written or queued
+        if payload == self._last_payload:
+            return
+        self._last_payload = payload
+        self._post(payload)
+
+    def _write_payload(self, payload):
+        # write everything to a temporary file then rename it over the real
+        # one so that readers never see a partially written file.  there is
+        # no fsync - the file is replaced every few seconds, so durability
+        # does not matter and the page cache can absorb the writes.
+        try:
+            with open(self.tmpname, 'w') as f:
+                f.write(payload)
+            os.rename(self.tmpname, self.filename)
+        except (IOError, OSError):
+            try:
+                os.remove(self.tmpname)
+            except OSError:
+                pass
+            raise
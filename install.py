@@ -10,7 +10,7 @@ def loader():
 class CWXNInstaller(ExtensionInstaller):
     def __init__(self):
         super(CWXNInstaller, self).__init__(
-            version="0.5",
+            version="0.6",
             name='cwxn',
             description='Emit a Cumulus wxnow.txt for LOOP data.',
             author="Matthew Wall",